@@ -113,6 +113,8 @@ class BasicLSTMNetwork(NeuralNetwork):
 
 		self.model.compile(loss='mean_squared_error', optimizer=opt)
 
+		self.makePredictFunctionKeras(self.model)
+
 		self.plotModel(self.model)
 
 	def train(self, givenDataset, givenLabels, args = {}, targetNormalization = None):
@@ -29,8 +29,9 @@ class Conv2DNetwork(NeuralNetwork):
 			newDataset = np.reshape(dataset, (-1, dataset.shape[1], dataset.shape[2], 1))
 
 		elif len(dataset.shape) == 4:
-			#reshape from N,time_steps,height,width to N,height,width,time_steps
-			newDataset = np.reshape(dataset, (-1, dataset.shape[2], dataset.shape[3], dataset.shape[1]))
+			#transpose from N,time_steps,height,width to channels-last N,height,width,time_steps;
+			#making it contiguous here saves the backend a per-batch layout conversion
+			newDataset = np.ascontiguousarray(np.transpose(dataset, (0, 2, 3, 1)))
 
 		return (newDataset, newLabels)
 
@@ -55,6 +56,7 @@ class Conv2DNetwork(NeuralNetwork):
 			args['lr'] = 0.0001
 		if 'kernel' not in args:
 			args['kernel'] = 3
+		args.setdefault('gpus', 0)
 
 		#remove any zero-size LSTM/dense layers
 		for arr in [args['CONV'], args['dense']]:
@@ -93,8 +95,12 @@ class Conv2DNetwork(NeuralNetwork):
 
 		opt = rmsprop(lr=args['lr'], decay=1e-6)
 
+		self.model = self.parallelizeModelKeras(self.model, args['gpus'])
+
 		self.model.compile(loss='mean_squared_error', optimizer=opt)
 
+		self.makePredictFunctionKeras(self.model)
+
 		self.plotModel(self.model)
 
 	def train(self, givenDataset, givenLabels, args = {}, targetNormalization = None):
@@ -122,8 +128,14 @@ class Conv2DNetwork(NeuralNetwork):
 
 		history = {}
 
+		#feed training through batch Sequences so batches are sliced off the training thread
+		trainData = self.makeInputPipeline(dataset['train'], labels['train'], args['batch'])
+		testData = self.makeInputPipeline(dataset['test'], labels['test'], args['batch'])
+
 		for i in range(args['epoch']):
-			epochHist = self.model.fit(dataset['train'], labels['train'], validation_data=(dataset['test'], labels['test']), epochs=1, batch_size=args['batch'], verbose=1, shuffle=False)
+			#workers/max_queue_size keep the next batches staged ahead of the step,
+			#the closest standalone-Keras gets to device-side prefetching
+			epochHist = self.model.fit_generator(trainData, validation_data=testData, epochs=1, verbose=1, shuffle=False, workers=2, use_multiprocessing=False, max_queue_size=4)
 
 			prediction = self.model.predict(dataset['test'], batch_size=args['batch'])
 			currLabels = labels['test']
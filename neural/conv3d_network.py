@@ -27,8 +27,9 @@ class Conv3DNetwork(NeuralNetwork):
 		if len(dataset.shape) == 3:
 			raise ValueError("Conv3d does not support input shaped %s!" % str(dataset.shape))
 		elif len(dataset.shape) == 4:
-			#reshape from N,time_steps,height,width to N,height,width,time_steps, 1
-			newDataset = np.reshape(dataset, (-1, dataset.shape[2], dataset.shape[3], dataset.shape[1]))
+			#transpose from N,time_steps,height,width to channels-last N,height,width,time_steps,1;
+			#making it contiguous here saves the backend a per-batch layout conversion
+			newDataset = np.ascontiguousarray(np.transpose(dataset, (0, 2, 3, 1)))
 			newDataset = np.reshape(newDataset, (*newDataset.shape, 1))
 
 		return (newDataset, newLabels)
@@ -55,6 +56,7 @@ class Conv3DNetwork(NeuralNetwork):
 		if 'kernel' not in args:
 			args['kernel'] = 3
 		args.setdefault('pool', 2)
+		args.setdefault('gpus', 0)
 
 		#remove any zero-size LSTM/dense layers
 		for arr in [args['CONV'], args['dense']]:
@@ -96,8 +98,12 @@ class Conv3DNetwork(NeuralNetwork):
 
 		opt = rmsprop(lr=args['lr'], decay=1e-6)
 
+		self.model = self.parallelizeModelKeras(self.model, args['gpus'])
+
 		self.model.compile(loss='mean_squared_error', optimizer=opt)
 
+		self.makePredictFunctionKeras(self.model)
+
 		self.plotModel(self.model)
 
 	def train(self, givenDataset, givenLabels, args = {}, targetNormalization = None):
@@ -125,8 +131,14 @@ class Conv3DNetwork(NeuralNetwork):
 
 		history = {}
 
+		#feed training through batch Sequences so batches are sliced off the training thread
+		trainData = self.makeInputPipeline(dataset['train'], labels['train'], args['batch'])
+		testData = self.makeInputPipeline(dataset['test'], labels['test'], args['batch'])
+
 		for i in range(args['epoch']):
-			epochHist = self.model.fit(dataset['train'], labels['train'], validation_data=(dataset['test'], labels['test']), epochs=1, batch_size=args['batch'], verbose=1, shuffle=False)
+			#workers/max_queue_size keep the next batches staged ahead of the step,
+			#the closest standalone-Keras gets to device-side prefetching
+			epochHist = self.model.fit_generator(trainData, validation_data=testData, epochs=1, verbose=1, shuffle=False, workers=2, use_multiprocessing=False, max_queue_size=4)
 
 			prediction = self.model.predict(dataset['test'], batch_size=args['batch'])
 			currLabels = labels['test']
@@ -4,7 +4,7 @@ import sys, os
 import numpy as np
 import math
 from sklearn.metrics import mean_squared_error
-from keras.utils import plot_model
+from keras.utils import plot_model, Sequence
 from keras import backend as K
 from keras.models import load_model
 
@@ -14,6 +14,21 @@ from aroundZeroNormalizer import AroundZeroNormalizer
 from basicNormalizer import BasicNormalizer
 from imageNormalizer import ImageNormalizer
 
+class BatchSequence(Sequence):
+	#batched view over in-memory arrays; Keras's enqueuer slices the batches on
+	#background workers so they are staged ahead of the training step
+	def __init__(self, dataset, labels, batchSize):
+		self.dataset = dataset
+		self.labels = labels
+		self.batchSize = batchSize
+
+	def __len__(self):
+		return int(math.ceil(len(self.dataset) / self.batchSize))
+
+	def __getitem__(self, index):
+		batch = slice(index * self.batchSize, (index + 1) * self.batchSize)
+		return self.dataset[batch], self.labels[batch]
+
 class NeuralNetwork(abc.ABC):
 
 	def __init__(self):
@@ -155,11 +170,14 @@ class NeuralNetwork(abc.ABC):
 				history[key].append(newPart[key])
 
 	@staticmethod
-	def reverse_target_normalization(targets, normalizationList):
+	def reverse_target_normalization(targets, normalizationList, out=None):
 		if targets.shape[1] != len(normalizationList):
 			raise ValueError("Mismatch between target length (%d) and normalizationList length (%d)." %(len(targets), len(normalizationList)))
-		
-		newTargets = np.ndarray(targets.shape)
+
+		if out is not None and out.shape == targets.shape:
+			newTargets = out #reuse the caller's buffer instead of allocating
+		else:
+			newTargets = np.ndarray(targets.shape)
 
 		for i in range(targets.shape[1]):
 			if normalizationList[i] is not None:
@@ -189,13 +207,63 @@ class NeuralNetwork(abc.ABC):
 	def plotModel(model):
 		plot_model(model, to_file='model.png')
 
+	@staticmethod
+	def enableMixedPrecision():
+		#the tf.keras mixed_float16 dtype policy is ignored by the standalone Keras
+		#layers used here, so switch on the backend-level auto mixed precision
+		#graph rewrite instead, which casts eligible ops to float16 at session time
+		import tensorflow as tf
+
+		try:
+			tf.config.optimizer.set_experimental_options({'auto_mixed_precision': True})
+		except AttributeError: #TF 1.x exposes the rewrite through the environment
+			os.environ['TF_ENABLE_AUTO_MIXED_PRECISION'] = '1'
+
+		print("Enabled the auto mixed precision graph rewrite.")
+
+	@staticmethod
+	def enableXLA():
+		import tensorflow as tf
+
+		try:
+			tf.config.optimizer.set_jit(True) #fuse the training-step kernels via XLA
+		except AttributeError: #TF 1.x: turn the JIT on through the session config
+			config = tf.ConfigProto()
+			config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+			K.set_session(tf.Session(config=config))
+
+		print("Enabled XLA JIT compilation.")
+
+	@staticmethod
+	def makeInputPipeline(dataset, labels, batchSize):
+		#standalone Keras model.fit only understands plain arrays, so batched
+		#feeding goes through a Sequence consumed by fit_generator
+		return BatchSequence(dataset, labels, batchSize)
+
+	@staticmethod
+	def parallelizeModelKeras(model, gpus):
+		if gpus and gpus > 1:
+			from keras.utils import multi_gpu_model
+			print("Replicating the model on %d GPUs." % gpus)
+			return multi_gpu_model(model, gpus=gpus) #shards each batch across the replicas
+		return model
+
 	@staticmethod
 	def saveModelKeras(model, filepath):
 		model.save(filepath)
 	
+	@staticmethod
+	def makePredictFunctionKeras(model):
+		#build the predict function eagerly so it is traced once and every
+		#later predict() call reuses it instead of rebuilding the graph
+		if hasattr(model, '_make_predict_function'):
+			model._make_predict_function()
+		return model
+
 	@staticmethod
 	def loadModelKeras(filepath):
 		try:
-			return load_model(filepath)
+			model = load_model(filepath)
 		except OSError:
-			return load_model(filepath+'.h5')
+			model = load_model(filepath+'.h5')
+		return NeuralNetwork.makePredictFunctionKeras(model)
@@ -5,8 +5,17 @@ import time
 import dateutil.parser
 import argparse
 import pickle
+import gzip
+import re
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
+
+try:
+	from numba import njit
+except ImportError: #numba is optional, simulateTrading falls back to the NumPy path
+	njit = None
+
 import matplotlib as mpl
 #mpl.use('Agg') #for use without X server. Disable if needed
 import matplotlib.pyplot as plt
@@ -19,24 +28,161 @@ from basic_lstm_network import BasicLSTMNetwork
 from conv2d_network import Conv2DNetwork
 from conv3d_network import Conv3DNetwork
 
-globalModels = [Conv2DNetwork(), Conv3DNetwork(), BasicLSTMNetwork()]
+#lazy registry: networks are only constructed once selected, so unselected
+#models never build any backend state
+globalModels = {
+	'conv2d': Conv2DNetwork,
+	'conv3d': Conv3DNetwork,
+	'lstm': BasicLSTMNetwork,
+}
 
 modelExtension = '.h5'
-historyExtension = '.pickle'
+historyExtension = '.pickle.gz'
 graphExtension = '.svg'
 
+datasetKinds = ['warm', 'train', 'test']
+
+argPairPattern = re.compile(r'([^=,]+)=([^,]+)') #key=value pairs of the --args string
+
+def datasetArrayFilename(filename, kind, key):
+	return '%s.%s_%s.npy' % (filename, kind, key)
+
+def convertDataset(filename):
+	#one-time conversion of a pickled dataset into per-array .npy files,
+	#so that loadDataset can memory-map them instead of materializing everything
+	with open(filename, 'rb') as f:
+		rawDataset = pickle.load(f)
+
+	normalization = []
+
+	for i, kind in enumerate(datasetKinds):
+		for key in ['dataset', 'labels', 'dates']:
+			np.save(datasetArrayFilename(filename, kind, key), rawDataset[i][key])
+		normalization.append(rawDataset[i]['normalization'])
+
+	#the normalizers are plain objects, they stay pickled
+	with open(filename + '.normalization.pickle', 'wb') as f:
+		pickle.dump(normalization, f, pickle.HIGHEST_PROTOCOL)
+
+	print("Converted dataset %s to .npy storage." % filename)
+
 def loadDataset(filename):
+	if os.path.exists(datasetArrayFilename(filename, 'warm', 'dataset')):
+		with open(filename + '.normalization.pickle', 'rb') as f:
+			normalization = pickle.load(f)
+
+		rawDataset = []
+
+		for i, kind in enumerate(datasetKinds):
+			rawDataset.append({
+				#memory-map the big tensor so trimming slices are views and only the
+				#pages actually touched become resident
+				'dataset': np.load(datasetArrayFilename(filename, kind, 'dataset'), mmap_mode='r'),
+				'labels': np.load(datasetArrayFilename(filename, kind, 'labels')),
+				'dates': np.load(datasetArrayFilename(filename, kind, 'dates'), allow_pickle=True),
+				'normalization': normalization[i],
+			})
+
+		return rawDataset
+
 	with open(filename, 'rb') as f:
 		return pickle.load(f)
 
-def randomizeDataset(dataset, labels, dates):
-	permutation = np.random.permutation(labels.shape[0])
-	shuffled_dataset = dataset[permutation,:,:]
-	shuffled_labels = labels[permutation]
-	shuffled_dates = dates[permutation]
-	return shuffled_dataset, shuffled_labels, shuffled_dates
+def randomizeDataset(dataset, labels, dates, out=None):
+	rng = np.random.default_rng()
+	permutation = rng.permutation(labels.shape[0]) #one shared permutation for all three arrays
+
+	if out is None:
+		out = np.empty_like(dataset)
+
+	#gather the big tensor in a single pass; callers can pass a reusable buffer via 'out'
+	np.take(dataset, permutation, axis=0, out=out)
+
+	return out, labels[permutation], dates[permutation]
+
+def trainAndEvaluateModel(model, dataset, labels, normalization, perm, sortedDates, sortedActuals, modelArgs, saveModel, loadModel, quiet, train, datasetFile, gpuId=None, buffers=None):
+	if gpuId is not None:
+		#pin this worker to its own GPU; TF picks the device up when its first session is created
+		os.environ['CUDA_VISIBLE_DEVICES'] = str(gpuId)
+
+		#worker figures only ever go to files, and the interactive backends are
+		#not fork safe (TkAgg opens its window as soon as the figure is created)
+		plt.switch_backend('Agg')
+
+		if saveModel is not None:
+			#workers run concurrently, give each model its own output files so the
+			#.h5/history/graph writes cannot interleave on a shared path
+			saveModel = '%s_%s' % (saveModel, model.name.lower())
+
+	history = None
+
+	if loadModel:
+		model.load(loadModel)
+	if train:
+		history = model.train(dataset, labels, modelArgs, targetNormalization = normalization['train'])
+
+		print(history)
+
+		if saveModel is not None:
+			model.save(saveModel+modelExtension)
+			#gzip streams the pickle to disk compressed, the history arrays shrink several-fold
+			with gzip.open(saveModel+historyExtension, 'wb', compresslevel=3) as f:
+				data = {}
+				data['history'] = history
+				data['model'] = model.name
+				data['dataset'] = datasetFile
+				data['args'] = modelArgs
+
+				pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+
+	if saveModel is None and (quiet or gpuId is not None):
+		#no graph would be saved, and pool workers can never show one, so skip
+		#the prediction gather and the figure entirely
+		print("Skipping the accuracy graph for %s." % model.name)
+		return (model.name, history)
+
+	if not quiet:
+		print("Running prediction with the %s network." % model.name)
+
+	predictions = []
+	actuals = []
+	datesList = []
+
+	#predict both sets in one forward pass and split the result afterwards
+	combined = np.concatenate((dataset['train'], dataset['test']))
+	trainLen = len(dataset['train'])
+
+	combinedRes = model.predict(combined)
+	split = {'train': combinedRes[:trainLen], 'test': combinedRes[trainLen:]}
 
-def run(datasetFile, models, modelArgs={}, saveModel=None, loadModel=None, quiet=False, shuffle=True, trim=False, train=True):
+	if buffers is None:
+		buffers = {}
+
+	for setType in ['train', 'test']:
+		if setType not in buffers:
+			#one normalization buffer and one gather buffer per set, reused across models
+			buffers[setType] = (np.ndarray(split[setType].shape), np.ndarray(split[setType].shape))
+
+		normBuffer, gatherBuffer = buffers[setType]
+
+		res = NeuralNetwork.reverse_target_normalization(split[setType], normalization[setType], out=normBuffer)
+		np.take(res, perm[setType], axis=0, out=gatherBuffer)
+
+		predictions.append(gatherBuffer)
+		actuals.append(sortedActuals[setType])
+		datesList.append(sortedDates[setType])
+
+	filename = None
+
+	if saveModel is not None:
+		filename = saveModel+graphExtension
+
+	#never plt.show() from a pool worker, there is no display loop to run it on
+	drawAccuracyGraph(model.name, datesList, predictions, actuals, history=history, filename=filename, show=not quiet and gpuId is None)
+
+	return (model.name, history)
+
+def run(datasetFile, models, modelArgs={}, saveModel=None, loadModel=None, quiet=False, shuffle=True, trim=False, train=True, dtype='float32', parallel=False):
 	#load the datasets
 	print("Loading dataset %s." % datasetFile)
 	rawDataset = loadDataset(datasetFile)
@@ -56,108 +202,129 @@ def run(datasetFile, models, modelArgs={}, saveModel=None, loadModel=None, quiet
 				print("Trimming %s dataset." % kind)
 			targetLen -= targetLen % modelArgs['batch']
 
-		dataset[kind] = rawDataset[i]['dataset'][:targetLen]
+		#cast the trimmed slices down from the stored float64, every later bulk
+		#operation (shuffle, predict staging, reverse-normalization) is memory-bound
+		dataset[kind] = np.asarray(rawDataset[i]['dataset'][:targetLen], dtype=dtype)
 
-		labels[kind] = rawDataset[i]['labels'][:targetLen]
+		labels[kind] = np.asarray(rawDataset[i]['labels'][:targetLen], dtype=dtype)
 
 		dates[kind] = rawDataset[i]['dates'][:targetLen]
 
 		normalization[kind] = rawDataset[i]['normalization']
 
 
-	selectedModels = []
-
 	if shuffle:
 		print("Shuffling train dataset.")
 		dataset['train'], labels['train'], dates['train'] = randomizeDataset(dataset['train'], labels['train'], dates['train'])
 
-	if models != None:
-		for model in globalModels:
-			if model.name.lower() in models: #case insensitive
-				selectedModels.append(model)
-	else: selectedModels = globalModels
+	#instantiate only the requested networks; names are case insensitive
+	selectedModels = [globalModels[name]() for name in (models if models != None else globalModels) if name in globalModels]
 
 	if not quiet:
 		print("Starting to train and evaluate the following networks: ", [net.name for net in selectedModels])
 
-	for model in selectedModels:
-		if loadModel:
-			model.load(loadModel)
-		if train:
-			history[model.name] = model.train(dataset, labels, modelArgs, targetNormalization = normalization['train'])
+	#sort the dates and the actual values once, they are the same for every model
+	perm = {}
+	sortedDates = {}
+	sortedActuals = {}
 
-			print(history[model.name])
+	for setType in ['train', 'test']:
+		perm[setType] = dates[setType].argsort()
+		sortedDates[setType] = dates[setType][perm[setType]]
 
-			if saveModel is not None:
-				model.save(saveModel+modelExtension)
-				with open(saveModel+historyExtension, 'wb') as f:
-					data = {}
-					data['history'] = history[model.name]
-					data['model'] = model.name
-					data['dataset'] = datasetFile
-					data['args'] = modelArgs
+		actual = NeuralNetwork.reverse_target_normalization(labels[setType], normalization[setType])
+		sortedActuals[setType] = actual[perm[setType]]
 
-					pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+	if parallel and len(selectedModels) > 1:
+		#the networks are independent, train and evaluate each in its own process
+		#with its own GPU; histories come back through the futures
+		print("Training the networks in %d parallel processes." % len(selectedModels))
 
-	if not quiet:
-		print("Trained the networks.")
+		with ProcessPoolExecutor(max_workers=len(selectedModels)) as executor:
+			futures = [executor.submit(trainAndEvaluateModel, model, dataset, labels, normalization, perm, sortedDates, sortedActuals, modelArgs, saveModel, loadModel, quiet, train, datasetFile, gpuId=i) for i, model in enumerate(selectedModels)]
+
+			for future in futures:
+				name, hist = future.result()
+				history[name] = hist
+	else:
+		#per-set buffers reused by every model, so the reverse-normalization and the
+		#sort gather don't reallocate two fresh arrays per set per model
+		buffers = {}
+
+		for model in selectedModels:
+			name, hist = trainAndEvaluateModel(model, dataset, labels, normalization, perm, sortedDates, sortedActuals, modelArgs, saveModel, loadModel, quiet, train, datasetFile, buffers=buffers)
+			history[name] = hist
 
 	if not quiet:
-		print("Running prediction on test dataset.")
+		print("Trained and evaluated the networks.")
+	print("Used dataset %s and arguments %s" % (datasetFile, modelArgs))
 
-	for model in selectedModels:
-		predictions = []
-		actuals = []
-		datesList = []
+def _simulateTradingLoop(prediction, actual, startBalance):
+	balance = startBalance #start with the stable currency
 
-		for setType in ['train', 'test']:
-			res = NeuralNetwork.reverse_target_normalization(model.predict(dataset[setType]), normalization[setType])
-			actual = NeuralNetwork.reverse_target_normalization(labels[setType], normalization[setType])
+	crypto = 0.0 #1.0 while holding crypto (predicted), 0.0 while holding the stable one
 
-			p = dates[setType].argsort()
-			predictions.append(res[p])
-			actuals.append(actual[p])
-			datesList.append(dates[setType][p])
+	lastPriceBoughtCrypto = 1.0
 
-		filename = None
+	timesTraded = 0.0
 
-		if saveModel is not None:
-			filename = saveModel+graphExtension
-		hist = history.get(model.name, None)
-		drawAccuracyGraph(model.name, datesList, predictions, actuals, history=hist, filename=filename)
-	print("Used dataset %s and arguments %s" % (datasetFile, modelArgs))
+	for i in range(min(len(actual), len(prediction) - 1)):
+		curr = actual[i]
+		signal = np.float64(prediction[i+1] > curr) #1.0 whenever the crypto price is predicted to raise
 
-def simulateTrading(prediction, actual, startBalance):
-	balance = startBalance #start with 100 of the stable currency
+		#branchless state machine: every update is gated by a 0/1 mask,
+		#so the loop body is straight-line FP code with no mispredicts
+		buy = signal * (1.0 - crypto)
+		sell = signal * crypto
+
+		balance = balance * (1.0 + sell * (curr - 1.0)) / (1.0 + buy * (curr - 1.0))
+		lastPriceBoughtCrypto = buy * curr + (1.0 - buy) * lastPriceBoughtCrypto
+		crypto = crypto + buy - sell
+		timesTraded = timesTraded + signal
+
+	#if we have finished with balance on crypto, revert last time we bought it.
+	balance = balance * (1.0 + crypto * (lastPriceBoughtCrypto - 1.0))
 
-	crypto = False #what currency are we holding? crypto (predicted) or the stable one.
+	return (balance, int(timesTraded))
 
-	lastPriceBoughtCrypto = 1
+if njit is not None:
+	_simulateTradingLoop = njit(cache=True, fastmath=True)(_simulateTradingLoop)
 
-	timesTraded = 0
+def _simulateTradingNumpy(prediction, actual, startBalance):
+	#only look at steps that still have a next-step prediction
+	steps = max(min(len(actual), len(prediction) - 1), 0)
 
-	for i, curr in enumerate(actual):
-		if i >= len(prediction) - 1: break
+	curr = actual[:steps]
+	pred = prediction[1:steps+1]
 
-		pred = prediction[i+1]
+	#every signal toggles between holding the stable currency and holding crypto,
+	#so the even signals are buys and the odd ones are sells
+	trades = np.where(pred > curr)[0]
+	buys = curr[trades[0::2]]
+	sells = curr[trades[1::2]]
+
+	#multiply the bounded per-trade ratios, not two separate price products that
+	#overflow float64 on long series; an unmatched trailing buy simply drops out,
+	#which is the same as reverting the last time we bought crypto
+	balance = startBalance * np.prod(sells / buys[:len(sells)])
+
+	return (balance, len(trades))
+
+def simulateTrading(prediction, actual, startBalance):
+	prediction = np.ascontiguousarray(prediction, dtype=np.float64)
+	actual = np.ascontiguousarray(actual, dtype=np.float64)
 
-		if not crypto and pred > curr: #if the crypto price will raise and we're not on crypto
-			crypto = True
-			balance /= curr
-			lastPriceBoughtCrypto = curr
-			timesTraded += 1
-		elif crypto and curr < pred: #if the crypto price will fall and we are holding crypto
-			crypto = False
-			balance *= curr
-			timesTraded += 1
+	if njit is not None:
+		return _simulateTradingLoop(prediction, actual, startBalance)
 
-	if crypto:
-		balance *= lastPriceBoughtCrypto #if we have finished with balance on crypto, revert last time we bought it.
-		crypto = False
+	return _simulateTradingNumpy(prediction, actual, startBalance)
 
-	return (balance, timesTraded)
+def drawAccuracyGraph(name, dates, predictions, actuals, history=None, filename=None, show=True):
+	if filename is None and not show:
+		return #nowhere to save it and nobody to show it to, don't build the figure
+
+	plt.rcParams['path.simplify_threshold'] = 1.0 #cheapest path simplification for long series
 
-def drawAccuracyGraph(name, dates, predictions, actuals, history=None, filename=None):
 	fig = plt.figure(figsize=(16*2, 9*2))
 
 	if type(predictions) != list:
@@ -183,14 +350,19 @@ def drawAccuracyGraph(name, dates, predictions, actuals, history=None, filename=
 
 	for prediction, actual, date in zip(predictions, actuals, dates):
 		for i in range(actual.shape[1]):
-			plt.subplot(gs[currRow, :])
+			ax = plt.subplot(gs[currRow, :])
 			currRow += 1
 
-			plt.plot(date, actual[:, i], label='Target %d' % i, color='blue')
 			if prediction is not None:
-				plt.plot(date, prediction[:, i], label='Predicted %d' % i, color='red')
-			plt.x = date
-			plt.legend(loc='upper left')
+				#a single plot call with a 2D array draws both lines without per-column Python overhead
+				lines = ax.plot(date, np.stack((actual[:, i], prediction[:, i]), axis=-1))
+				lines[0].set_color('blue')
+				lines[0].set_label('Target %d' % i)
+				lines[1].set_color('red')
+				lines[1].set_label('Predicted %d' % i)
+			else:
+				ax.plot(date, actual[:, i], label='Target %d' % i, color='blue')
+			ax.legend(loc='upper left')
 	if history is not None:
 		for i, measure in enumerate(list(history.keys())):
 			plt.subplot(gs[currRow, i])
@@ -224,9 +396,30 @@ def init():
 	parser.set_defaults(noReplace=False)
 	parser.add_argument('--no-train', dest='train', action="store_false", help="Do not train, only evaluathe the model.")
 	parser.set_defaults(train=True)
+	parser.add_argument('--convert', dest='convert', action="store_true", help="Convert a pickled dataset to .npy files that are memory-mapped on load.")
+	parser.set_defaults(convert=False)
+	parser.add_argument('--dtype', type=str, default='float32', choices=['float16', 'float32', 'float64'], help="The dtype the datasets are cast to on load.")
+	parser.add_argument('--parallel', dest='parallel', action="store_true", help="Train and evaluate the selected models in parallel processes, one GPU each.")
+	parser.set_defaults(parallel=False)
+	parser.add_argument('--amp', dest='amp', action="store_true", help="Enable the auto mixed precision graph rewrite (float16 compute on tensor cores).")
+	parser.set_defaults(amp=False)
+	parser.add_argument('--xla', dest='xla', action="store_true", help="JIT-compile the training graphs with XLA for kernel fusion.")
+	parser.set_defaults(xla=False)
 
 	args, _ = parser.parse_known_args()
 
+	if args.convert:
+		convertDataset(args.dataset)
+
+	if args.amp:
+		NeuralNetwork.enableMixedPrecision() #set the policy before any model is built
+
+	if args.xla:
+		NeuralNetwork.enableXLA()
+
+	if args.quiet and args.saveModel is not None:
+		plt.switch_backend('Agg') #graphs only go to files, no need for an interactive backend
+
 	if args.noReplace and args.saveModel is not None:
 		if os.path.exists(args.saveModel+modelExtension):
 			print("The file already exists and the 'no-replace' flag is used.")
@@ -235,23 +428,26 @@ def init():
 	givenModels = [x.lower() for x in args.models.split(',')] if args.models else None
 
 	modelArgs = {}
-	pairs = args.args.split(',') if args.args else []
-	for pair in pairs:
-		key, value = pair.split('=')
-
+	#each comma-separated token must fully match key=value, typos fail loudly
+	#instead of silently training with defaults
+	for pair in (args.args.split(',') if args.args else []):
+		match = argPairPattern.fullmatch(pair)
+		if match is None:
+			raise ValueError("Malformed model argument '%s', expected key=value." % pair)
+		key, value = match.groups()
 		try:
-			value = float(value)
-			if value == int(value):
-				value = int(value)
+			value = int(value)
 		except ValueError:
-			if ':' in value:
-				value = [int(i) for i in value.split(':')]
-			pass
+			try:
+				value = float(value)
+			except ValueError:
+				if ':' in value:
+					value = [int(i) for i in value.split(':')]
 		modelArgs[key] = value
 
 	print("Processed model arguments", modelArgs)
 
-	run(args.dataset, givenModels, modelArgs=modelArgs, quiet=args.quiet, saveModel=args.saveModel, loadModel=args.loadModel, shuffle=args.shuffle, trim=args.trim, train=args.train)
+	run(args.dataset, givenModels, modelArgs=modelArgs, quiet=args.quiet, saveModel=args.saveModel, loadModel=args.loadModel, shuffle=args.shuffle, trim=args.trim, train=args.train, dtype=args.dtype, parallel=args.parallel)
 
 if __name__ == "__main__": #if this is the main file, parse the command args
 	init()
\ No newline at end of file